@@ -0,0 +1,299 @@
+"""Incremental sync of ABQ data record CSVs to a central collector.
+
+The data entry app only ever appends to its daily CSV files, so a station
+remembers how many bytes of each file the collector already holds and sends
+just the records written after that point, gzip-compressed and in batches.
+
+Run the collector on the central machine (or locally as a stand-in):
+
+    python data_sync.py collect --dir central_records --port 5050
+
+and push from a field laptop, from the directory holding the CSVs:
+
+    python data_sync.py push --host central-machine --port 5050
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import struct
+
+RECORD_PATTERN = 'abq_data_record_*.csv'
+STATE_FILENAME = '.abq_sync_state.json'
+DEFAULT_PORT = 5050
+BATCH_SIZE = 64 * 1024
+TAIL_SIZE = 4096
+
+_LENGTH = struct.Struct('!I')
+
+
+# Wire protocol: every message is a length-prefixed JSON header,
+# optionally followed by a body of header['size'] bytes.
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by peer')
+        data.extend(chunk)
+    return bytes(data)
+
+
+def send_message(sock, header, body=b''):
+    header = dict(header, size=len(body))
+    raw = json.dumps(header).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(raw)) + raw + body)
+
+
+def recv_message(sock):
+    (length,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    header = json.loads(_recv_exact(sock, length).decode('utf-8'))
+    body = _recv_exact(sock, header.get('size', 0))
+    return header, body
+
+
+def record_boundaries(data):
+    """Yield the end offset of every complete CSV record in data.
+
+    data must start on a record boundary.  A newline only ends a record
+    when it is outside quotes, so multi-line Notes stay in one record.
+    """
+    start = 0
+    quotes = 0
+    while True:
+        newline = data.find(b'\n', start)
+        if newline == -1:
+            return
+        quotes += data.count(b'"', start, newline)
+        start = newline + 1
+        if quotes % 2 == 0:
+            quotes = 0
+            yield start
+
+
+def tail_checksum(fh, offset):
+    """Checksum the last TAIL_SIZE bytes before offset.
+
+    Cheap enough to check on every sync, and catches a file that was
+    replaced or rewritten rather than appended to.
+    """
+    start = max(0, offset - TAIL_SIZE)
+    fh.seek(start)
+    return hashlib.sha256(fh.read(offset - start)).hexdigest()
+
+
+# Station side
+class SyncState:
+    """Per-file offsets and tail checksums of data the collector holds"""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, 'r') as fh:
+                self.files = json.load(fh).get('files', {})
+
+    def get(self, filename):
+        return self.files.get(filename, {'offset': 0, 'checksum': None})
+
+    def update(self, filename, offset, checksum):
+        self.files[filename] = {'offset': offset, 'checksum': checksum}
+        self.save()
+
+    def save(self):
+        # Write and rename so an interrupted save never corrupts the state
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fh:
+            json.dump({'files': self.files}, fh, indent=2)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, self.path)
+
+
+class SyncClient:
+    """Pushes newly appended records to a collector"""
+
+    def __init__(self, host='localhost', port=DEFAULT_PORT, directory='.',
+    station=None, batch_size=BATCH_SIZE, timeout=30):
+        self.address = (host, port)
+        self.directory = directory
+        self.station = station or socket.gethostname()
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.state = SyncState(os.path.join(directory, STATE_FILENAME))
+
+    def record_files(self):
+        return sorted(glob.glob(os.path.join(self.directory, RECORD_PATTERN)))
+
+    def sync(self, paths=None):
+        """Sync every record file and return transfer totals"""
+        paths = paths or self.record_files()
+        stats = {'files': 0, 'batches': 0, 'bytes': 0, 'sent_bytes': 0}
+        with socket.create_connection(self.address, self.timeout) as sock:
+            for path in paths:
+                self._sync_file(sock, path, stats)
+        return stats
+
+    def _start_offset(self, fh, filename, size):
+        saved = self.state.get(filename)
+        offset = saved['offset']
+        if offset > size or (
+            offset and tail_checksum(fh, offset) != saved['checksum']
+        ):
+            # The file no longer extends what was sent; send it again
+            return 0
+        return offset
+
+    def _sync_file(self, sock, path, stats):
+        filename = os.path.basename(path)
+        with open(path, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            offset = self._start_offset(fh, filename, size)
+            if offset == size:
+                return
+            stats['files'] += 1
+            while offset < size:
+                fh.seek(offset)
+                sent = self._send_records(
+                    sock, fh, filename, offset, fh.read(size - offset), stats
+                )
+                if sent == offset:
+                    # Only a partially written record is left
+                    break
+                offset = sent
+
+    def _send_records(self, sock, fh, filename, offset, data, stats):
+        """Send the complete records in data, batch by batch"""
+        batch_start = batch_end = 0
+        for end in record_boundaries(data):
+            if end - batch_start > self.batch_size and batch_end > batch_start:
+                expected = offset + batch_end
+                sent = self._send_batch(sock, fh, filename, offset + batch_start,
+                    data[batch_start:batch_end], stats)
+                if sent != expected:
+                    return sent
+                batch_start = batch_end
+            batch_end = end
+        if batch_end > batch_start:
+            return self._send_batch(sock, fh, filename, offset + batch_start,
+                data[batch_start:batch_end], stats)
+        return offset + batch_start
+
+    def _send_batch(self, sock, fh, filename, offset, batch, stats):
+        body = gzip.compress(batch)
+        send_message(sock, {
+            'station': self.station,
+            'file': filename,
+            'offset': offset,
+            'length': len(batch),
+            'checksum': hashlib.sha256(batch).hexdigest(),
+        }, body)
+        reply, _ = recv_message(sock)
+        status = reply.get('status')
+        if status == 'ok':
+            stats['batches'] += 1
+            stats['bytes'] += len(batch)
+            stats['sent_bytes'] += len(body)
+        elif status != 'rewind':
+            raise RuntimeError('Collector rejected {}: {}'.format(
+                filename, reply.get('error', status)
+            ))
+        # On 'rewind' the collector holds less than we thought, so resume
+        # from its offset instead.
+        new_offset = reply['offset']
+        self.state.update(filename, new_offset, tail_checksum(fh, new_offset))
+        return new_offset
+
+
+# Collector side
+class CollectorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                header, body = recv_message(self.connection)
+            except ConnectionError:
+                return
+            send_message(self.connection, self.server.store(header, body))
+
+
+class Collector(socketserver.ThreadingTCPServer):
+    """Receives record batches and appends them to per-station copies"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, directory, host='', port=DEFAULT_PORT):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        super().__init__((host, port), CollectorHandler)
+
+    def _target(self, station, filename):
+        for name in (station, filename):
+            if not name or name != os.path.basename(name) or name in ('.', '..'):
+                raise ValueError('Invalid name: {!r}'.format(name))
+        station_dir = os.path.join(self.directory, station)
+        os.makedirs(station_dir, exist_ok=True)
+        return os.path.join(station_dir, filename)
+
+    def store(self, header, body):
+        try:
+            path = self._target(header['station'], header['file'])
+            offset = header['offset']
+            batch = gzip.decompress(body)
+        except (KeyError, ValueError, OSError) as e:
+            return {'status': 'error', 'error': str(e)}
+
+        if (len(batch) != header.get('length')
+                or hashlib.sha256(batch).hexdigest() != header.get('checksum')):
+            return {'status': 'error', 'error': 'Checksum mismatch'}
+
+        current = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset > current:
+            return {'status': 'rewind', 'offset': current}
+
+        # offset < current means a previous reply was lost; the batch
+        # replaces what was written then.
+        with open(path, 'r+b' if current else 'wb') as fh:
+            fh.seek(offset)
+            fh.write(batch)
+            fh.truncate()
+            fh.flush()
+            os.fsync(fh.fileno())
+        return {'status': 'ok', 'offset': offset + len(batch)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    collect = commands.add_parser('collect', help='run the collector')
+    collect.add_argument('--dir', default='collected_records')
+    collect.add_argument('--host', default='')
+    collect.add_argument('--port', type=int, default=DEFAULT_PORT)
+
+    push = commands.add_parser('push', help='send new records')
+    push.add_argument('files', nargs='*')
+    push.add_argument('--dir', default='.')
+    push.add_argument('--host', default='localhost')
+    push.add_argument('--port', type=int, default=DEFAULT_PORT)
+    push.add_argument('--station')
+
+    args = parser.parse_args()
+    if args.command == 'collect':
+        with Collector(args.dir, args.host, args.port) as server:
+            print('Collecting into {} on port {}'.format(args.dir, args.port))
+            server.serve_forever()
+    else:
+        client = SyncClient(args.host, args.port, args.dir, args.station)
+        stats = client.sync(args.files)
+        print('{files} files, {batches} batches, {bytes} bytes '
+              '({sent_bytes} compressed)'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()